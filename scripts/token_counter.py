@@ -12,7 +12,10 @@ import sys
 import argparse
 import json
 import csv
-from datetime import datetime
+import time
+import tempfile
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 # Optional exact tokenization
 try:
@@ -20,34 +23,265 @@ try:
 except Exception:
     tiktoken = None
 
-def approx_token_count(text: str) -> int:
+# Optional fast JSON serialization
+try:
+    import orjson
+except Exception:
+    orjson = None
+
+def dumps_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def utc_timestamp() -> str:
+    # ISO-8601 UTC with microseconds, without building a datetime
+    s, us = divmod(time.time_ns() // 1000, 1_000_000)
+    return f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(s))}.{us:06d}Z"
+
+def approx_from_counts(chars: int, newlines: int) -> int:
     # Calibrated approximation: ~4 chars/token average for English-like text
     # Add small overhead for newlines/markdown
-    return max(1, int((len(text) + text.count("\n")) / 4))
+    return max(1, int((chars + newlines) / 4))
 
-def exact_token_count(text: str, model: str = "gpt-4o") -> int:
-    if tiktoken is None:
-        return approx_token_count(text)
+def approx_token_count(text: str) -> int:
+    return approx_from_counts(len(text), text.count("\n"))
+
+# Encoders keyed by model hint; None marks a hint that couldn't be resolved
+_ENC_CACHE: dict = {}
+
+def get_encoder(model: str = "gpt-4o"):
+    if model in _ENC_CACHE:
+        return _ENC_CACHE[model]
+    enc = None
     try:
-        enc = tiktoken.get_encoding("cl100k_base")
+        enc = tiktoken.encoding_for_model(model)
     except Exception:
-        # Fallback to model lookup if available
         try:
-            enc = tiktoken.encoding_for_model(model)
+            enc = tiktoken.get_encoding("cl100k_base")
         except Exception:
-            return approx_token_count(text)
-    return len(enc.encode(text))
-
-def scan_files(root: str, exts: list[str]) -> list[str]:
-    paths = []
-    for base, _, files in os.walk(root):
-        for fn in files:
-            if not exts:  # no filter → include all
-                paths.append(os.path.join(base, fn))
-            else:
-                if any(fn.lower().endswith(e.lower()) for e in exts):
-                    paths.append(os.path.join(base, fn))
-    return sorted(paths)
+            pass
+    _ENC_CACHE[model] = enc
+    return enc
+
+# Directories never worth auditing; pruned from the walk so they aren't descended
+SKIP_DIRS = {".git", ".venv", "venv", "node_modules", "__pycache__",
+             ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox", "dist", "build"}
+
+def parse_exts(spec: str) -> frozenset:
+    # ".md,py, .JSON" → {".md", ".py", ".json"}; empty → no filter
+    exts = (e.strip().lower() for e in spec.split(","))
+    return frozenset(e if e.startswith(".") else "." + e for e in exts if e)
+
+def scan_files(root: str, exts: frozenset) -> list[tuple[str, int, int]]:
+    # (path, size, mtime_ns) triples; stats come from the same scandir pass so callers
+    # can filter before opening anything
+    found = []
+    stack = [root]
+    while stack:
+        base = stack.pop()
+        try:
+            it = os.scandir(base)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name.lower() not in SKIP_DIRS:
+                        stack.append(entry.path)
+                    continue
+                if not entry.is_file():
+                    continue
+                if exts:
+                    i = entry.name.rfind(".")
+                    if i < 0 or entry.name[i:].lower() not in exts:
+                        continue
+                try:
+                    st = entry.stat()
+                    found.append((entry.path, st.st_size, st.st_mtime_ns))
+                except OSError:
+                    continue
+    return sorted(found)
+
+# Files are read and tokenized ~1 MiB at a time; chunks stay under a few
+# CHUNK_BYTES even for files with no usable line breaks
+CHUNK_BYTES = 1 << 20
+
+def line_cut(buf: bytes) -> int:
+    # Offset just past the last "\n" that is followed by printable ASCII, or -1.
+    # No tiktoken pretokenizer pattern spans a newline into a following
+    # non-space character, so counts there add up exactly.
+    i = len(buf) - 1
+    while True:
+        i = buf.rfind(b"\n", 0, i)
+        if i < 0:
+            return -1
+        if 0x21 <= buf[i + 1] <= 0x7E:
+            return i + 1
+
+def split_point(buf: bytes) -> int:
+    # Fallback when no line_cut exists: cut before the last space/tab so a
+    # leading-space token stays whole; failing that, before a trailing
+    # partial UTF-8 sequence. Counts may drift by a token or so here.
+    cut = max(buf.rfind(b" "), buf.rfind(b"\t"))
+    if cut > 0:
+        return cut
+    cut = len(buf)
+    while cut > 0 and buf[cut - 1] & 0xC0 == 0x80:
+        cut -= 1
+    if cut > 0 and buf[cut - 1] >= 0xC0:
+        cut -= 1
+    # Keep a trailing "\r" with its "\n" so newline translation matches
+    if cut > 0 and buf[cut - 1] == 0x0D:
+        cut -= 1
+    return cut or len(buf)
+
+def iter_chunks(f, size: int = CHUNK_BYTES):
+    # Yields raw byte chunks cut at line_cut() boundaries (which also keep
+    # UTF-8 whole); the tail after the cut is carried into the next chunk
+    carry = b""
+    while True:
+        data = f.read(size)
+        if not data:
+            if carry:
+                yield carry
+            return
+        buf = carry + data
+        cut = line_cut(buf)
+        if cut < 0:
+            if len(buf) < 2 * size:
+                carry = buf
+                continue
+            cut = split_point(buf)
+        buf, carry = buf[:cut], buf[cut:]
+        yield buf
+
+def decode_chunk(raw: bytes) -> str:
+    # Match text-mode reading: drop invalid UTF-8, translate universal newlines
+    buf = raw.decode("utf-8", errors="ignore")
+    if "\r" in buf:
+        buf = buf.replace("\r\n", "\n").replace("\r", "\n")
+    return buf
+
+# Chunks of a large file are handed to tiktoken together so its Rust core can
+# encode them on several threads. Pool workers already use every core, so
+# they drop to one thread (batches of one) in init_worker().
+ENCODE_THREADS = os.cpu_count() or 1
+
+def init_worker() -> None:
+    global ENCODE_THREADS
+    ENCODE_THREADS = 1
+
+def encode_batch_len(enc, chunks: list[str]) -> int:
+    # Audit files are plain text, so skip special-token scanning
+    if len(chunks) == 1:
+        try:
+            return len(enc.encode_ordinary(chunks[0]))
+        except AttributeError:
+            return len(enc.encode(chunks[0]))
+    try:
+        return sum(map(len, enc.encode_ordinary_batch(chunks, num_threads=len(chunks))))
+    except AttributeError:
+        # Older tiktoken without the batch API
+        return sum(len(enc.encode(c)) for c in chunks)
+
+def count_method(enc) -> str:
+    # Encoding name for exact counts, "approx" for the heuristic fallback
+    return enc.name if enc is not None else "approx"
+
+def count_file(path: str, model: str = "gpt-4o", size: int = -1) -> tuple:
+    # (path, tokens, bytes, method), or (path, None, None, error) on failure.
+    # Top-level so it pickles cleanly into worker processes
+    enc = get_encoder(model) if tiktoken is not None else None
+    if size == 0:
+        tokens = 0 if enc is not None else approx_token_count("")
+        return path, tokens, 0, count_method(enc)
+    tokens = chars = newlines = nbytes = 0
+    batch = []
+    try:
+        with open(path, "rb") as f:
+            for raw in iter_chunks(f):
+                nbytes += len(raw)
+                buf = decode_chunk(raw)
+                if enc is not None:
+                    batch.append(buf)
+                    if len(batch) >= ENCODE_THREADS:
+                        tokens += encode_batch_len(enc, batch)
+                        batch = []
+                else:
+                    chars += len(buf)
+                    newlines += buf.count("\n")
+            if batch:
+                tokens += encode_batch_len(enc, batch)
+    except Exception as e:
+        return path, None, None, str(e)
+    if enc is None:
+        tokens = approx_from_counts(chars, newlines)
+    return path, tokens, nbytes, count_method(enc)
+
+def count_files(files: list[tuple[str, int, int]], model: str = "gpt-4o"):
+    # Yields count_file() results in input order as they arrive
+    # Small audits aren't worth the process startup cost
+    if len(files) < 8:
+        for p, size, _ in files:
+            yield count_file(p, model, size)
+        return
+    paths = [f[0] for f in files]
+    sizes = [f[1] for f in files]
+    with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=init_worker) as ex:
+        yield from ex.map(count_file, paths, [model] * len(paths), sizes, chunksize=32)
+
+DEFAULT_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "token_counter", "cache.json")
+
+def load_cache(path: str) -> dict:
+    # {tokenizer: {abs_path: [size, mtime_ns, tokens, bytes]}}; unreadable → empty
+    try:
+        with open(path, "rb") as f:
+            cache = json.loads(f.read())
+    except Exception:
+        return {}
+    return cache if isinstance(cache, dict) else {}
+
+def cache_hit(entries: dict, path: str, size: int, mtime_ns: int):
+    # Returns (tokens, bytes) for a fresh, well-formed entry; anything else is a miss
+    hit = entries.get(path)
+    if (isinstance(hit, list) and len(hit) == 4
+            and all(type(v) is int for v in hit)
+            and hit[0] == size and hit[1] == mtime_ns):
+        return hit[2], hit[3]
+    return None
+
+def prune_cache(cache: dict, root: str, seen: set) -> int:
+    # Drop entries under a scanned directory that this scan didn't visit
+    # (deleted, filtered out or oversize files); returns how many went
+    prefix = os.path.join(os.path.abspath(root), "")
+    dropped = 0
+    for entries in cache.values():
+        if not isinstance(entries, dict):
+            continue
+        stale = [p for p in entries if p.startswith(prefix) and p not in seen]
+        for p in stale:
+            del entries[p]
+        dropped += len(stale)
+    return dropped
+
+def save_cache(path: str, cache: dict) -> None:
+    # Unique temp file so concurrent runs never clobber each other's writes
+    base = os.path.dirname(path) or "."
+    os.makedirs(base, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=base, prefix=".cache-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(cache, separators=(",", ":")).encode("utf-8"))
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
 
 def main():
     ap = argparse.ArgumentParser()
@@ -56,57 +290,95 @@ def main():
     ap.add_argument("--ext", default=".md,.py,.json", help="comma-separated file extensions to include (blank = all)")
     ap.add_argument("--json", dest="json_out", default="", help="optional JSON output path")
     ap.add_argument("--csv", dest="csv_out", default="", help="optional CSV output path")
+    ap.add_argument("--cache", default=DEFAULT_CACHE, help="token count cache keyed by size+mtime (blank = off)")
+    ap.add_argument("--max-bytes", type=int, default=5_000_000, help="skip files larger than this (0 = no limit)")
     args = ap.parse_args()
 
     root = args.path
-    exts = [e.strip() for e in args.ext.split(",") if e.strip()] if args.ext is not None else []
+    exts = parse_exts(args.ext or "")
 
-    paths = []
+    files = []
     if os.path.isdir(root):
-        paths = scan_files(root, exts)
+        files = scan_files(root, exts)
     elif os.path.isfile(root):
-        paths = [root]
+        st = os.stat(root)
+        files = [(root, st.st_size, st.st_mtime_ns)]
     else:
         print(f"[!] Path not found: {root}")
         sys.exit(1)
 
-    results = []
-    total_tokens = 0
-    for p in paths:
+    if args.max_bytes > 0:
+        for p, size, _ in files:
+            if size > args.max_bytes:
+                print(f"[skip] {p}: {size:,} bytes exceeds --max-bytes")
+        files = [f for f in files if f[1] <= args.max_bytes]
+
+    # Reuse counts for files whose size and mtime haven't changed. The bucket
+    # is the tokenizer that actually loaded, so approximate counts never land
+    # under an exact one.
+    method = count_method(get_encoder(args.model) if tiktoken is not None else None)
+    cache = load_cache(args.cache) if args.cache else {}
+    if not isinstance(cache.get(method), dict):
+        cache[method] = {}
+    entries = cache[method]
+    # Columns are filled straight from cache hits and worker results
+    file_paths = []
+    file_tokens = array("q")
+    file_bytes = array("q")
+    todo = []
+    seen = set()
+    for f in files:
+        p, size, mtime_ns = f
+        seen.add(os.path.abspath(p))
+        hit = cache_hit(entries, os.path.abspath(p), size, mtime_ns)
+        if hit is None:
+            todo.append(f)
+            continue
+        file_paths.append(p)
+        file_tokens.append(hit[0])
+        file_bytes.append(hit[1])
+    for (_, size, mtime_ns), (p, tokens, nbytes, info) in zip(todo, count_files(todo, args.model)):
+        if tokens is None:
+            print(f"[skip] {p}: {info}")
+            continue
+        file_paths.append(p)
+        file_tokens.append(tokens)
+        file_bytes.append(nbytes)
+        if info == method:
+            entries[os.path.abspath(p)] = [size, mtime_ns, tokens, nbytes]
+    dropped = prune_cache(cache, root, seen) if os.path.isdir(root) else 0
+    if args.cache and (todo or dropped):
         try:
-            with open(p, "r", encoding="utf-8", errors="ignore") as f:
-                txt = f.read()
+            save_cache(args.cache, cache)
         except Exception as e:
-            print(f"[skip] {p}: {e}")
-            continue
-        tokens = exact_token_count(txt, args.model)
-        total_tokens += tokens
-        results.append({
-            "path": p,
-            "tokens": tokens,
-            "bytes": len(txt.encode('utf-8', errors='ignore'))
-        })
+            print(f"[x] Cache write failed: {e}")
+    total_tokens = sum(file_tokens)
 
-    results.sort(key=lambda r: r["tokens"], reverse=True)
+    # Ties break on path, matching the walk order regardless of cache hits
+    order = sorted(range(len(file_tokens)), key=lambda i: (-file_tokens[i], file_paths[i]))
+
+    ts = utc_timestamp()
 
     # Console summary
-    print(f"\n== Token Audit ({datetime.utcnow().isoformat()}Z) ==")
-    print(f" Scanned: {len(results)} files\n Total tokens: {total_tokens:,}\n")
+    print(f"\n== Token Audit ({ts}) ==")
+    print(f" Scanned: {len(order)} files\n Total tokens: {total_tokens:,}\n")
     print(" Top files:")
-    for r in results[:10]:
-        print(f"  - {r['path']}  ::  {r['tokens']:,} tokens")
-
-    payload = {
-        "timestamp_utc": datetime.utcnow().isoformat() + "Z",
-        "model_hint": args.model,
-        "total_tokens": total_tokens,
-        "files": results
-    }
+    for i in order[:10]:
+        print(f"  - {file_paths[i]}  ::  {file_tokens[i]:,} tokens")
 
     if args.json_out:
+        payload = {
+            "timestamp_utc": ts,
+            "model_hint": args.model,
+            "total_tokens": total_tokens,
+            "files": [
+                {"path": file_paths[i], "tokens": file_tokens[i], "bytes": file_bytes[i]}
+                for i in order
+            ]
+        }
         try:
-            with open(args.json_out, "w", encoding="utf-8") as f:
-                json.dump(payload, f, ensure_ascii=False, indent=2)
+            with open(args.json_out, "wb") as f:
+                f.write(dumps_json(payload))
             print(f"\n[✓] JSON written → {args.json_out}")
         except Exception as e:
             print(f"[x] JSON write failed: {e}")
@@ -116,8 +388,7 @@ def main():
             with open(args.csv_out, "w", newline="", encoding="utf-8") as f:
                 w = csv.writer(f)
                 w.writerow(["path", "tokens", "bytes"])
-                for r in results:
-                    w.writerow([r["path"], r["tokens"], r["bytes"]])
+                w.writerows((file_paths[i], file_tokens[i], file_bytes[i]) for i in order)
             print(f"[✓] CSV written  → {args.csv_out}")
         except Exception as e:
             print(f"[x] CSV write failed: {e}")